@@ -1,10 +1,15 @@
 import streamlit as st
 from audio_recorder_streamlit import audio_recorder
 from openai import OpenAI
-from tempfile import NamedTemporaryFile
+import httpx
+import numpy as np
+import soundfile as sf
 import base64
-import streamlit.components.v1 as components
+import io
+import os
 import time
+import re
+from concurrent.futures import ThreadPoolExecutor
 
 # Streamlit Secrets から API キーを取得
 api_key = st.secrets.get("OPENAI_API_KEY", "")
@@ -12,42 +17,99 @@ api_key = st.secrets.get("OPENAI_API_KEY", "")
 # サイドバーでAPIキーを入力できるようにする（オプション）
 api_key = st.sidebar.text_input("OpenAI API Key", type="password", value=api_key, key="api_key_input")
 
+# -------------------------------------------------------
+# 関数名
+# get_client
+# 
+# 引数
+# key：OpenAIのAPIキー
+# 
+# 概要
+# OpenAIクライアントを生成する（APIキーごとに1度だけ生成し、以降は再利用）
+# 再実行をまたいでHTTP/2・Keep-Alive接続を使い回し、TLSハンドシェイクを省く
+# -------------------------------------------------------
+@st.cache_resource(show_spinner=False)
+def get_client(key):
+    http_client = httpx.Client(
+        http2=True,
+        limits=httpx.Limits(max_keepalive_connections=20, keepalive_expiry=300)
+    )
+    return OpenAI(api_key=key, http_client=http_client)
+
 # OpenAI クライアントの初期化
-client = OpenAI(api_key=api_key)
+client = get_client(api_key)
+
+# 文字起こしのバックエンド（"openai"：Whisper API、"local"：faster-whisper）
+WHISPER_BACKEND = os.environ.get("WHISPER_BACKEND", "openai")
+# faster-whisperに渡す言語コードとサンプリングレート
+LANGUAGE_CODES = {"Japanese": "ja", "English": "en"}
+WHISPER_SAMPLE_RATE = 16000
 
 # セッション状態の初期化
 if 'audio_bytes_japanese' not in st.session_state:
     st.session_state.audio_bytes_japanese = None
 if 'audio_bytes_english' not in st.session_state:
     st.session_state.audio_bytes_english = None
-if 'messages_japanese' not in st.session_state:
-    st.session_state.messages_japanese = []
-if 'messages_english' not in st.session_state:
-    st.session_state.messages_english = []
+# 日本語・英語のメッセージを発話順に保持する（(メッセージ, 言語) のタプル）
+if 'all_messages' not in st.session_state:
+    st.session_state.all_messages = []
+
+# -------------------------------------------------------
+# 関数名
+# load_whisper_model
+# 
+# 概要
+# faster-whisperのモデルを読み込む（プロセス内で1度だけ読み込み、以降は再利用）
+# GPUが使える場合はFP16、使えない場合はCPU上のINT8で動かす
+# ※ WHISPER_BACKEND=local の場合のみ使用（pip install faster-whisper が必要）
+# -------------------------------------------------------
+@st.cache_resource(show_spinner="音声認識モデルを読み込み中...")
+def load_whisper_model():
+    import ctranslate2
+    from faster_whisper import WhisperModel
+
+    if ctranslate2.get_cuda_device_count() > 0:
+        return WhisperModel("small", device="cuda", compute_type="float16")
+    return WhisperModel("small", device="cpu", compute_type="int8")
 
 # -------------------------------------------------------
 # 関数名
 # transcribe_audio
 # 
 # 引数
-# audio_bytes：バイト形式の音声データ
+# samples：decode_audioで変換済みのfloat32のモノラル波形
+# sample_rate：サンプリングレート
+# language：音声の言語（"Japanese" または "English"）
 # 
 # 概要
-# 音声データ（バイト形式）を一時ファイルに保存し、
-# OpenAIのWhisper APIを使用して音声をテキストに変換
-# -------------------------------------------------------
-def transcribe_audio(audio_bytes):
-    # 一時ファイルを作成し音声データを書き込み
-    with NamedTemporaryFile(delete=True, suffix=".wav") as temp_audio_file:
-        temp_audio_file.write(audio_bytes)
-        temp_audio_file.flush()
-        
-        # 音声をテキストに変換
-        with open(temp_audio_file.name, "rb") as audio_file:
-            transcript = client.audio.transcriptions.create(
-                model="whisper-1",
-                file=audio_file
-            )
+# 音声データをテキストに変換
+# WHISPER_BACKENDが"local"の場合はローカルのfaster-whisperを、
+# それ以外の場合は16bit PCMのWAVにエンコードしてOpenAIのWhisper APIを使用する
+# -------------------------------------------------------
+def transcribe_audio(samples, sample_rate, language):
+    if WHISPER_BACKEND == "local":
+        # 変換済みの波形を16kHzにしてローカルで文字起こし
+        samples = resample_audio(samples, sample_rate, WHISPER_SAMPLE_RATE)
+        segments, _ = load_whisper_model().transcribe(
+            samples,
+            language=LANGUAGE_CODES[language],
+            beam_size=1,
+            vad_filter=True
+        )
+        return "".join(segment.text for segment in segments).strip()
+
+    # 一時ファイルを介さずメモリ上のバッファを渡す（nameはファイル形式の判定に使われる）
+    audio_file = io.BytesIO()
+    sf.write(audio_file, samples, sample_rate, format="WAV", subtype="PCM_16")
+    audio_file.seek(0)
+    audio_file.name = "audio.wav"
+
+    # 音声をテキストに変換
+    transcript = client.audio.transcriptions.create(
+        model="whisper-1",
+        file=audio_file,
+        language=LANGUAGE_CODES[language]
+    )
     return transcript.text
 
 # -------------------------------------------------------
@@ -59,11 +121,12 @@ def transcribe_audio(audio_bytes):
 # target_lang：翻訳先の言語
 # 
 # 概要
-# 入力されたテキストを指定された言語に翻訳
+# 入力されたテキストを指定された言語に翻訳し、
+# 生成されたテキストをトークン単位で逐次返す（ストリーミング）
 # -------------------------------------------------------
 def translate_text(text, target_lang):
-    # GPT-3.5-turboモデルにリクエストを送信
-    response = client.chat.completions.create(
+    # GPT-3.5-turboモデルにストリーミングでリクエストを送信
+    stream = client.chat.completions.create(
         model="gpt-3.5-turbo",
         messages=[
             {"role": "system", "content": "You are a helpful assistant that translates text."},
@@ -72,27 +135,113 @@ def translate_text(text, target_lang):
         max_tokens=1000,
         n=1,
         temperature=0.5,
+        stream=True,
     )
-    return response.choices[0].message.content.strip()
+    for chunk in stream:
+        if chunk.choices and chunk.choices[0].delta.content:
+            yield chunk.choices[0].delta.content
 
 # -------------------------------------------------------
 # 関数名
-# text_to_speech
+# stream_speech
 # 
 # 引数
 # text： 音声に変換したいテキスト
 # voice：使用する音声タイプ（デフォルトは"alloy"）
 # 
 # 概要
-# OpenAIのTTS APIを使用して、テキストを高品質な音声に変換
+# OpenAIのTTS APIのストリーミングレスポンスを使用して、
+# 生成された音声（MP3）を届いた順にチャンク単位で返す
 # -------------------------------------------------------
-def text_to_speech(text):
-    response = client.audio.speech.create(
+def stream_speech(text, voice="alloy"):
+    with client.audio.speech.with_streaming_response.create(
         model="tts-1",
-        voice="alloy",
-        input=text
-    )
-    return response.content
+        voice=voice,
+        input=text,
+        response_format="mp3"
+    ) as response:
+        yield from response.iter_bytes(4096)
+
+# -------------------------------------------------------
+# 関数名
+# synthesize_speech
+# 
+# 引数
+# text： 音声に変換したいテキスト
+# voice：使用する音声タイプ（デフォルトは"alloy"）
+# 
+# 概要
+# OpenAIのTTS APIを使用して、テキストを高品質な音声に変換
+# -------------------------------------------------------
+def synthesize_speech(text, voice="alloy"):
+    return b"".join(stream_speech(text, voice))
+
+# 文の区切り（日本語の句点類、または空白が続く英語の終止符）
+SENTENCE_PATTERN = re.compile(r".*?(?:[。！？]|[.!?](?=\s))", re.S)
+
+# -------------------------------------------------------
+# 関数名
+# translate_and_speak
+# 
+# 引数
+# text：翻訳したい元のテキスト
+# target_lang：翻訳先の言語
+# 
+# 概要
+# 翻訳結果をストリーミングで受け取り、文が完成するたびに音声合成を
+# 別スレッドで開始することで、翻訳と音声合成を並行して行う
+# 翻訳後のテキストと、文ごとの音声を連結した音声データを返す
+# -------------------------------------------------------
+def translate_and_speak(text, target_lang):
+    buffer = ""
+    translated_text = ""
+    futures = []
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        for token in translate_text(text, target_lang):
+            buffer += token
+            translated_text += token
+            # 完成した文から順に音声合成を開始
+            while (match := SENTENCE_PATTERN.match(buffer)):
+                sentence = match.group().strip()
+                buffer = buffer[match.end():]
+                if sentence:
+                    futures.append(executor.submit(synthesize_speech, sentence))
+        # 終止符のない残りのテキストも音声に変換
+        if buffer.strip():
+            futures.append(executor.submit(synthesize_speech, buffer.strip()))
+        # MP3のフレームはそのまま連結して再生できる
+        audio_content = b"".join(future.result() for future in futures)
+    return translated_text.strip(), audio_content
+
+# -------------------------------------------------------
+# 関数名
+# normalize_text
+# 
+# 引数
+# text：正規化したいテキスト
+# 
+# 概要
+# キャッシュのヒット率を上げるため、前後の空白・連続する空白・大文字小文字の
+# 違いを吸収したキャッシュキーを返す
+# -------------------------------------------------------
+def normalize_text(text):
+    return " ".join(text.split()).lower()
+
+# -------------------------------------------------------
+# 関数名
+# cached_translate_and_speak
+# 
+# 引数
+# cache_key：normalize_textで正規化したテキスト（キャッシュキー）
+# target_lang：翻訳先の言語
+# _text：翻訳したい元のテキスト（キャッシュキーには含めない）
+# 
+# 概要
+# translate_and_speakの結果をキャッシュし、同じ発話の翻訳・音声合成を再利用する
+# -------------------------------------------------------
+@st.cache_data(ttl=86400, max_entries=2048, show_spinner=False)
+def cached_translate_and_speak(cache_key, target_lang, _text):
+    return translate_and_speak(_text, target_lang)
 
 # -------------------------------------------------------
 # 関数名
@@ -102,23 +251,103 @@ def text_to_speech(text):
 # audio_content：バイナリ形式の音声データ
 # 
 # 概要
-# Base64エンコードされた音声データを自動再生するHTMLとJavaScriptを生成し、
-# Streamlitコンポーネントとして表示する
+# Base64エンコードされた音声データを自動再生するaudio要素を生成し、表示する
+# （JavaScriptやコンポーネントのiframeを使わず、ブラウザの自動再生で再生する）
 # -------------------------------------------------------
 def autoplay_audio(audio_content):
     # バイナリ形式の音声データをBase64エンコードされた文字列に変換
     audio_base64 = base64.b64encode(audio_content).decode('utf-8')
-    # 音声再生
-    components.html(
-        f"""
-        <script>
-        const audio = new Audio("data:audio/mp3;base64,{audio_base64}");
-        audio.play();
-        </script>
-        """,
-        height=0,
+    # 音声再生（controlsを付けないため画面には表示されない）
+    st.markdown(
+        f'<audio autoplay src="data:audio/mp3;base64,{audio_base64}"></audio>',
+        unsafe_allow_html=True
     )
 
+# 音声区間検出（VAD）のパラメータ
+VAD_FRAME_SECONDS = 0.03     # 判定に使うフレーム長（30ms）
+VAD_RMS_THRESHOLD = 0.01     # 発話とみなすフレームの最小RMS
+VAD_MAX_ZCR = 0.35           # これを超えるゼロ交差率のフレームはノイズとみなす
+MIN_SPEECH_SECONDS = 0.3     # 発話とみなす合計時間の下限
+MIN_RECORDING_SECONDS = 0.4  # 録音時間の下限
+TRIM_PADDING_SECONDS = 0.2   # 無音を切り取る際に発話の前後に残す余白
+
+# -------------------------------------------------------
+# 関数名
+# decode_audio
+# 
+# 引数
+# audio_bytes：バイト形式の音声データ（WAV）
+# 
+# 概要
+# 音声データをfloat32のモノラル波形とサンプリングレートに変換
+# -------------------------------------------------------
+def decode_audio(audio_bytes):
+    samples, sample_rate = sf.read(io.BytesIO(audio_bytes), dtype="float32")
+    # ステレオの場合はモノラルに変換
+    if samples.ndim > 1:
+        samples = samples.mean(axis=1)
+    return samples, sample_rate
+
+# -------------------------------------------------------
+# 関数名
+# resample_audio
+# 
+# 引数
+# samples：float32のモノラル波形
+# sample_rate：元のサンプリングレート
+# target_rate：変換後のサンプリングレート
+# 
+# 概要
+# 線形補間で波形を指定したサンプリングレートに変換（音声認識用には十分な精度）
+# -------------------------------------------------------
+def resample_audio(samples, sample_rate, target_rate):
+    if sample_rate == target_rate:
+        return samples
+    n_target = int(len(samples) * target_rate / sample_rate)
+    positions = np.arange(n_target) * (sample_rate / target_rate)
+    return np.interp(positions, np.arange(len(samples)), samples).astype(np.float32)
+
+# -------------------------------------------------------
+# 関数名
+# detect_voiced_frames
+# 
+# 引数
+# samples：float32のモノラル波形
+# sample_rate：サンプリングレート
+# 
+# 概要
+# 波形をVAD_FRAME_SECONDSごとのフレームに分け、
+# RMSとゼロ交差率から各フレームが発話かどうかを判定した配列を返す
+# -------------------------------------------------------
+def detect_voiced_frames(samples, sample_rate):
+    frame_length = int(sample_rate * VAD_FRAME_SECONDS)
+    n_frames = len(samples) // frame_length
+    frames = samples[:n_frames * frame_length].reshape(n_frames, frame_length)
+
+    rms = np.sqrt(np.mean(frames ** 2, axis=1))
+    zcr = np.mean(np.abs(np.diff(np.signbit(frames), axis=1)), axis=1)
+    return (rms > VAD_RMS_THRESHOLD) & (zcr < VAD_MAX_ZCR)
+
+# -------------------------------------------------------
+# 関数名
+# trim_silence
+# 
+# 引数
+# samples：float32のモノラル波形
+# sample_rate：サンプリングレート
+# voiced：detect_voiced_framesで判定したフレームごとの発話判定
+# 
+# 概要
+# 最初と最後の発話フレームの外側にある無音を切り取る（前後に少し余白を残す）
+# -------------------------------------------------------
+def trim_silence(samples, sample_rate, voiced):
+    voiced_indices = np.flatnonzero(voiced)
+    frame_length = int(sample_rate * VAD_FRAME_SECONDS)
+    padding = int(sample_rate * TRIM_PADDING_SECONDS)
+    start = max(voiced_indices[0] * frame_length - padding, 0)
+    end = min((voiced_indices[-1] + 1) * frame_length + padding, len(samples))
+    return samples[start:end]
+
 # -------------------------------------------------------
 # 関数名
 # process_audio
@@ -133,31 +362,48 @@ def autoplay_audio(audio_content):
 # -------------------------------------------------------
 def process_audio(audio_bytes, source_lang, target_lang):
 
-    # 録音時間が短すぎる場合（例：1秒未満）の処理
-    if len(audio_bytes) < 16000:  # 16kHzのサンプリングレートを仮定
+    # 音声データを1度だけ波形に変換し、以降の判定・文字起こしで使い回す
+    try:
+        samples, sample_rate = decode_audio(audio_bytes)
+    except RuntimeError:
+        st.warning("録音データを読み込めませんでした。もう一度お試しください。")
+        return
+
+    # 録音時間が短すぎる場合の処理（WAVのヘッダや形式に依存しない実際の長さで判定）
+    if len(samples) / sample_rate < MIN_RECORDING_SECONDS:
         st.warning("録音時間が短すぎます。もう一度お試しください。")
         return
-        
+
+    # 無音・雑音のみの録音はAPIを呼ばずに終了
+    voiced = detect_voiced_frames(samples, sample_rate)
+    if np.count_nonzero(voiced) * VAD_FRAME_SECONDS < MIN_SPEECH_SECONDS:
+        st.warning("音声が検出されませんでした。もう一度お試しください。")
+        return
+
+    # 前後の無音を切り取り、文字起こしに送るデータ量を減らす
+    samples = trim_silence(samples, sample_rate, voiced)
+
     # 音声をテキストに変換
-    transcript = transcribe_audio(audio_bytes)
+    transcript = transcribe_audio(samples, sample_rate, source_lang)
     
-    # メッセージの重複をチェック
-    messages = st.session_state.messages_japanese if source_lang == "Japanese" else st.session_state.messages_english
-    if not messages or messages[-1]['content'] != transcript:
+    # メッセージの重複をチェック（同じ言語の直前のメッセージと比較）
+    lang = source_lang.lower()
+    last_message = next((msg for msg, msg_lang in reversed(st.session_state.all_messages) if msg_lang == lang), None)
+    if last_message is None or last_message['content'] != transcript:
         with st.spinner("処理中..."):
-            translated_text = translate_text(transcript, target_lang)
-        
+            # 翻訳と音声合成を並行して実行（同じ発話はキャッシュを再利用）
+            translated_text, audio_content = cached_translate_and_speak(normalize_text(transcript), target_lang, transcript)
+
             # 新しいメッセージオブジェクトを作成
             new_message = {
                 "content": transcript,
                 "translated": translated_text,
+                # 表示のたびに音声合成しないよう、翻訳音声を保持する
+                "audio": audio_content,
                 "timestamp": time.time()
             }
-            # メッセージリストに新しいメッセージを追加
-            messages.append(new_message)
-
-            # 翻訳されたテキストを音声に変換
-            audio_content = text_to_speech(translated_text)
+            # メッセージリストに新しいメッセージを追加（発話順なので並べ替えは不要）
+            st.session_state.all_messages.append((new_message, lang))
 
             # 音声を自動再生
             autoplay_audio(audio_content)
@@ -171,43 +417,8 @@ if 'messages' not in st.session_state:
 st.write("※マイクアイコンが表示されない場合はReloadボタンを押してください。")
 st.button("Reload")
 
-# レコーダーを横並びに配置
-col1, col2 = st.columns(2)
-
-# 日本語レコーダの処理
-with col1:
-    st.write("Japanese")
-    audio_bytes_japanese = audio_recorder(
-        pause_threshold=2.0,
-        recording_color="#e8b62c",
-        neutral_color="#6aa36f",
-        icon_name="microphone",
-        icon_size="5x",
-        key="recorder_1"
-    )
-
-    if audio_bytes_japanese:
-        st.session_state.audio_bytes_japanese = audio_bytes_japanese
-        process_audio(st.session_state.audio_bytes_japanese, "Japanese", "English")
-
-# 英語レコーダの処理
-with col2:
-    st.write("English")
-    audio_bytes_english = audio_recorder(
-        pause_threshold=2.0,
-        recording_color="#e8b62c",
-        neutral_color="#3498db",
-        icon_name="microphone",
-        icon_size="5x",
-        key="recorder_2"
-    )
-
-    if audio_bytes_english:
-        st.session_state.audio_bytes_english = audio_bytes_english
-        process_audio(st.session_state.audio_bytes_english, "English", "Japanese")
-
-# メッセージ表示エリア
-st.markdown("""
+# メッセージ表示エリアのスタイル
+MESSAGE_CSS = """
 <style>
 .message-container { display: flex; margin-bottom: 20px; align-items: flex-start; }
 .message-container.left { justify-content: flex-start; }
@@ -233,40 +444,78 @@ st.markdown("""
 .translation.japanese { background-color: #e6f7ff; color: #333333; }
 .translation.english { background-color: #e6ffe6; color: #333333; }
 </style>
-""", unsafe_allow_html=True)
-
-# 日本語と英語のメッセージを時系列順にマージ
-all_messages = sorted(
-    [(msg, 'japanese') for msg in st.session_state.messages_japanese] +
-    [(msg, 'english') for msg in st.session_state.messages_english],
-    key=lambda x: x[0].get('timestamp', 0)
-)
-
-# メッセージ表示(時系列順に表示、言語別に左右に表示)
-for i, (msg, lang) in enumerate(all_messages):
-    align = 'left' if lang == 'japanese' else 'right'
-    message_class = 'japanese-message' if lang == 'japanese' else 'english-message'
-    translation_class = 'english' if lang == 'japanese' else 'japanese'
-     
-    st.markdown(f"""
-    <div class="message-container {align}">
-        <div class="message-box-wrapper {align}">
-            <div class="message-box {message_class}">{msg['content']}</div>
-            <div class="message-box translation {translation_class}">{msg['translated']}</div>
-        </div>
-    </div>
-    """, unsafe_allow_html=True)
-
-    # 翻訳音声
+"""
+
+# -------------------------------------------------------
+# 関数名
+# conversation
+# 
+# 概要
+# レコーダーとメッセージ表示をまとめたフラグメント
+# 録音による再実行はこのフラグメント内だけで行われ、ページ全体は再実行しない
+# -------------------------------------------------------
+@st.fragment
+def conversation():
+    # レコーダーを横並びに配置
     col1, col2 = st.columns(2)
-    
-    # 翻訳されたテキストを音声に変換
-    audio_content = text_to_speech(msg['translated'])
-    # 音声データをBase64エンコードし、文字列に変換
-    audio_base64 = base64.b64encode(audio_content).decode('utf-8')
-    # Base64エンコードされた音声データを使用してHTMLのaudioタグを生成
-    audio_tag = f'<audio controls><source src="data:audio/mp3;base64,{audio_base64}" type="audio/mp3"></audio>'
-    
-    # 言語に応じて適切な列に音声プレーヤーを配置
-    with col1 if lang == 'japanese' else col2:
-        st.markdown(audio_tag, unsafe_allow_html=True)
\ No newline at end of file
+
+    # 日本語レコーダの処理
+    with col1:
+        st.write("Japanese")
+        audio_bytes_japanese = audio_recorder(
+            pause_threshold=2.0,
+            recording_color="#e8b62c",
+            neutral_color="#6aa36f",
+            icon_name="microphone",
+            icon_size="5x",
+            key="recorder_1"
+        )
+
+        # 処理済みの録音は再実行時に再び処理しない
+        if audio_bytes_japanese and audio_bytes_japanese != st.session_state.audio_bytes_japanese:
+            st.session_state.audio_bytes_japanese = audio_bytes_japanese
+            process_audio(st.session_state.audio_bytes_japanese, "Japanese", "English")
+
+    # 英語レコーダの処理
+    with col2:
+        st.write("English")
+        audio_bytes_english = audio_recorder(
+            pause_threshold=2.0,
+            recording_color="#e8b62c",
+            neutral_color="#3498db",
+            icon_name="microphone",
+            icon_size="5x",
+            key="recorder_2"
+        )
+
+        # 処理済みの録音は再実行時に再び処理しない
+        if audio_bytes_english and audio_bytes_english != st.session_state.audio_bytes_english:
+            st.session_state.audio_bytes_english = audio_bytes_english
+            process_audio(st.session_state.audio_bytes_english, "English", "Japanese")
+
+    # メッセージ表示(時系列順に表示、言語別に左右に表示)
+    if st.session_state.all_messages:
+        st.markdown(MESSAGE_CSS, unsafe_allow_html=True)
+
+    for msg, lang in st.session_state.all_messages:
+        align = 'left' if lang == 'japanese' else 'right'
+        message_class = 'japanese-message' if lang == 'japanese' else 'english-message'
+        translation_class = 'english' if lang == 'japanese' else 'japanese'
+
+        st.markdown(
+            f'<div class="message-container {align}">'
+            f'<div class="message-box-wrapper {align}">'
+            f'<div class="message-box {message_class}">{msg["content"]}</div>'
+            f'<div class="message-box translation {translation_class}">{msg["translated"]}</div>'
+            f'</div></div>',
+            unsafe_allow_html=True
+        )
+
+        # 翻訳音声
+        # st.audioは音声をバイナリのままStreamlitのメディアURLから配信するため、
+        # Base64のdata URIをページに埋め込む場合と違い、再実行ごとに音声データを送らずに済む
+        col1, col2 = st.columns(2)
+        with col1 if lang == 'japanese' else col2:
+            st.audio(msg['audio'], format="audio/mp3")
+
+conversation()